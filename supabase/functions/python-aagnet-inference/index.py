@@ -1,21 +1,107 @@
 import json
 import base64
+import binascii
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from typing import Dict, List, Any, Tuple
 import os
 import io
-import tempfile
+import secrets
 from supabase import create_client
 import struct
 from collections import defaultdict
+import threading
+
+# Use every core this process may run on inside each CPU matmul; os.cpu_count()
+# counts the whole host and oversubscribes a container pinned to fewer CPUs. Requests
+# run one graph at a time, so inter-op parallelism only adds thread contention
+if hasattr(os, 'sched_getaffinity'):
+    torch.set_num_threads(len(os.sched_getaffinity(0)))
+else:
+    torch.set_num_threads(os.cpu_count() or 1)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError as e:
+    # Only settable before any inter-op work has run in this process
+    print(f"Could not limit inter-op threads: {e}")
+torch.backends.mkldnn.enabled = True
 
 # Initialize Supabase client
 supabase_url = os.environ.get('SUPABASE_URL')
 supabase_key = os.environ.get('SUPABASE_SERVICE_ROLE_KEY')
 supabase = create_client(supabase_url, supabase_key)
 
+# Every supabase.storage access builds a new storage client with its own HTTP
+# session; keep one bucket client so listing and downloads reuse connections
+models_bucket = supabase.storage.from_('models')
+
+# Trained model reused across warm invocations until its checkpoint changes
+_MODEL = None
+_MODEL_VERSION = None
+_MODEL_LOCK = threading.Lock()
+
+# Largest decoded STEP payload accepted by the handler
+MAX_STEP_BYTES = 50 * 1024 * 1024
+
+class InvalidRequestError(ValueError):
+    """Client input the handler rejects with a 400 response"""
+
+# Your exact 25 feature types from the trained model
+FEAT_NAMES = (
+    'chamfer', 'through_hole', 'triangular_passage', 'rectangular_passage', '6sides_passage',
+    'triangular_through_slot', 'rectangular_through_slot', 'circular_through_slot',
+    'rectangular_through_step', '2sides_through_step', 'slanted_through_step', 'Oring', 'blind_hole',
+    'triangular_pocket', 'rectangular_pocket', '6sides_pocket', 'circular_end_pocket',
+    'rectangular_blind_slot', 'v_circular_end_blind_slot', 'h_circular_end_blind_slot',
+    'triangular_blind_step', 'circular_blind_step', 'rectangular_blind_step', 'round', 'stock'
+)
+STOCK_CLASS = FEAT_NAMES.index('stock')
+
+# Machining parameters per feature type: (tool type, tool diameter multiplier, fixed params)
+MACHINING_PARAMS = {
+    'hole': ('drill', 0.9, {'speed': 1200, 'feed_rate': 0.1, 'plunge_rate': 0.05}),
+    'pocket': ('end_mill', 0.3, {'speed': 800, 'feed_rate': 0.2, 'step_over': 0.6, 'step_down': 0.5}),
+    'slot': ('end_mill', 0.8, {'speed': 1000, 'feed_rate': 0.15, 'step_down': 0.3}),
+}
+DEFAULT_MACHINING_PARAMS = ('end_mill', 0.5, {'speed': 1000, 'feed_rate': 0.1})
+
+# Machining parameters resolved once per class index of FEAT_NAMES
+CLASS_MACHINING_PARAMS = tuple(MACHINING_PARAMS.get(name, DEFAULT_MACHINING_PARAMS) for name in FEAT_NAMES)
+CLASS_DIAMETER_RATIOS = np.array([ratio for _, ratio, _ in CLASS_MACHINING_PARAMS])
+
+class FaceSelfAttention(nn.Module):
+    """Multi-head self-attention over faces, keeping nn.MultiheadAttention's parameter names"""
+    def __init__(self, embed_dim, num_heads, dropout=0.):
+        super(FaceSelfAttention, self).__init__()
+        
+        self.num_heads = num_heads
+        self.dropout = dropout
+        
+        # Same packed q/k/v projection and output layer as nn.MultiheadAttention,
+        # so trained checkpoints load unchanged
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * embed_dim))
+        self.out_proj = nn.modules.linear.NonDynamicallyQuantizableLinear(embed_dim, embed_dim)
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.out_proj.bias)
+        
+    def forward(self, x):
+        num_faces, embed_dim = x.shape
+        
+        # One projection for q, k and v, split into per-head [heads, faces, head_dim] views
+        qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        q, k, v = qkv.view(num_faces, 3, self.num_heads, embed_dim // self.num_heads).permute(1, 2, 0, 3)
+        
+        # Called on the [faces, dim] tensor directly: no fake batch dim and no MHA
+        # fast-path conditions. torch 2.0 runs this on CPU with the math backend,
+        # which still builds the [heads, faces, faces] weights; 2.1+ can fuse it
+        dropout_p = self.dropout if self.training else 0.
+        attended = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        
+        return self.out_proj(attended.transpose(0, 1).reshape(num_faces, embed_dim))
+
 class AAGNetSegmentor(nn.Module):
     """
     Exact AAGNetSegmentor architecture from your trained model
@@ -49,7 +135,7 @@ class AAGNetSegmentor(nn.Module):
         # Graph attention layers
         self.num_layers = num_layers
         self.attention_layers = nn.ModuleList([
-            nn.MultiheadAttention(self.feature_dim, 8, batch_first=True, dropout=drop)
+            FaceSelfAttention(self.feature_dim, 8, dropout=drop)
             for _ in range(num_layers)
         ])
         
@@ -95,9 +181,8 @@ class AAGNetSegmentor(nn.Module):
         )
         
     def forward(self, batch_data):
-        # Extract node and edge features from batch
+        # Extract node features from batch; edge features are not used by this encoder
         node_attr = batch_data.x[:, :self.node_attr_dim]
-        edge_attr = batch_data.edge_attr if hasattr(batch_data, 'edge_attr') else None
         
         # Node embeddings
         x = self.node_attr_emb(node_attr)
@@ -111,8 +196,7 @@ class AAGNetSegmentor(nn.Module):
         # Apply attention layers
         for i in range(self.num_layers):
             # Self-attention
-            attended, _ = self.attention_layers[i](x.unsqueeze(0), x.unsqueeze(0), x.unsqueeze(0))
-            attended = attended.squeeze(0)
+            attended = self.attention_layers[i](x)
             
             # Residual connection and layer norm
             x = self.layer_norms[i](x + attended)
@@ -126,26 +210,18 @@ class AAGNetSegmentor(nn.Module):
         
         # Instance segmentation (pairwise face relations)
         num_faces = x.size(0)
-        face_pairs = []
-        for i in range(num_faces):
-            for j in range(i + 1, num_faces):
-                pair_feature = torch.cat([x[i], x[j]], dim=0)
-                face_pairs.append(pair_feature)
-        
-        if face_pairs:
-            pair_features = torch.stack(face_pairs)
-            inst_out = self.inst_head(pair_features)
-            # Reshape to adjacency matrix
-            inst_matrix = torch.zeros(num_faces, num_faces)
-            idx = 0
-            for i in range(num_faces):
-                for j in range(i + 1, num_faces):
-                    inst_matrix[i, j] = inst_out[idx, 0]
-                    inst_matrix[j, i] = inst_out[idx, 0]
-                    idx += 1
+        if num_faces > 1:
+            # Gather every (i, j) pair with i < j at once instead of looping in Python
+            pair_i, pair_j = torch.triu_indices(num_faces, num_faces, offset=1, device=x.device)
+            pair_features = torch.cat([x[pair_i], x[pair_j]], dim=-1)
+            pair_logits = self.inst_head(pair_features).squeeze(-1)
+            # Scatter the pair logits into a symmetric adjacency matrix
+            inst_matrix = x.new_zeros(num_faces, num_faces)
+            inst_matrix[pair_i, pair_j] = pair_logits
+            inst_matrix[pair_j, pair_i] = pair_logits
             inst_out = [inst_matrix]
         else:
-            inst_out = [torch.zeros(num_faces, num_faces)]
+            inst_out = [x.new_zeros(num_faces, num_faces)]
         
         # Bottom face detection
         bottom_out = self.bottom_head(x).squeeze(-1)
@@ -155,8 +231,12 @@ class AAGNetSegmentor(nn.Module):
 def parse_step_to_mesh(step_data: str) -> Dict[str, Any]:
     """Parse base64 encoded STEP data into mesh format with AAG features"""
     try:
-        # Decode base64 STEP data
-        step_text = base64.b64decode(step_data).decode('utf-8')
+        # Decode base64 STEP data; keep the raw bytes for the parser rather than
+        # holding a second decoded str copy of the whole file
+        try:
+            step_bytes = base64.b64decode(step_data, validate=True)
+        except binascii.Error as e:
+            raise InvalidRequestError(f"STEP data is not valid base64: {e}") from e
         
         # For now, we'll simulate proper STEP parsing
         # In production, you would use OpenCascade or similar
@@ -164,47 +244,28 @@ def parse_step_to_mesh(step_data: str) -> Dict[str, Any]:
         
         # Simulate geometric extraction (replace with actual STEP parsing)
         # This would normally extract faces, edges, and topology from STEP
-        vertices = []
-        faces = []
-        face_attributes = []
-        adjacency_matrix = []
+        num_faces = 50  # Simulate 50 faces
+        rng = np.random.default_rng()
         
         # Mock data for demonstration - replace with actual STEP parsing
-        for i in range(50):  # Simulate 50 faces
-            # Mock vertices for each face
-            v1 = [np.random.uniform(-10, 10) for _ in range(3)]
-            v2 = [np.random.uniform(-10, 10) for _ in range(3)]
-            v3 = [np.random.uniform(-10, 10) for _ in range(3)]
-            v4 = [np.random.uniform(-10, 10) for _ in range(3)]
-            
-            base_idx = len(vertices)
-            vertices.extend([v1, v2, v3, v4])
-            faces.append([base_idx, base_idx + 1, base_idx + 2, base_idx + 3])
-            
-            # AAG node attributes (10 dimensional as per your model)
-            face_attr = [
-                np.random.uniform(0, 1),  # area
-                np.random.uniform(-1, 1),  # normal_x
-                np.random.uniform(-1, 1),  # normal_y
-                np.random.uniform(-1, 1),  # normal_z
-                np.random.uniform(-5, 5),  # center_x
-                np.random.uniform(-5, 5),  # center_y
-                np.random.uniform(-5, 5),  # center_z
-                np.random.uniform(0, 2),   # curvature
-                np.random.uniform(0, 1),   # convexity
-                np.random.uniform(0, 1)    # planarity
-            ]
-            face_attributes.append(face_attr)
-        
-        # Mock adjacency matrix
-        num_faces = len(faces)
-        adjacency = np.random.rand(num_faces, num_faces) > 0.8
-        adjacency = adjacency.astype(float)
+        # Four vertices per face, generated for all faces at once
+        vertices = rng.uniform(-10, 10, size=(num_faces * 4, 3)).astype(np.float32)
+        faces = np.arange(num_faces * 4, dtype=np.int32).reshape(num_faces, 4)
+        
+        # AAG node attributes (10 dimensional as per your model), one range per column:
+        # area, normal_xyz, center_xyz, curvature, convexity, planarity
+        attr_low = np.array([0, -1, -1, -1, -5, -5, -5, 0, 0, 0], dtype=np.float32)
+        attr_high = np.array([1, 1, 1, 1, 5, 5, 5, 2, 1, 1], dtype=np.float32)
+        face_attributes = rng.uniform(attr_low, attr_high, size=(num_faces, 10)).astype(np.float32)
+        
+        # Mock adjacency matrix, symmetric like a real face adjacency graph
+        upper = np.triu(rng.random((num_faces, num_faces)) > 0.8, k=1)
+        adjacency = (upper | upper.T).astype(np.float32)
         
         return {
-            'vertices': np.array(vertices),
-            'faces': np.array(faces),
-            'face_attributes': np.array(face_attributes),
+            'vertices': vertices,
+            'faces': faces,
+            'face_attributes': face_attributes,
             'adjacency_matrix': adjacency,
             'num_faces': num_faces,
             'file_type': 'STEP'
@@ -213,6 +274,8 @@ def parse_step_to_mesh(step_data: str) -> Dict[str, Any]:
         print(f"Error parsing STEP: {e}")
         raise
 
+# Grad mode is thread-local, so disable autograd here for whichever thread loads
+@torch.no_grad()
 def load_trained_model(model_files: Dict[str, bytes]) -> torch.nn.Module:
     """Load your specific trained PyTorch model from storage"""
     try:
@@ -232,54 +295,60 @@ def load_trained_model(model_files: Dict[str, bytes]) -> torch.nn.Module:
         if model_file_data is None:
             raise ValueError("No trained .pth model file found in storage")
         
-        # Create temporary file to load the model
-        with tempfile.NamedTemporaryFile(suffix='.pth', delete=False) as tmp_file:
-            tmp_file.write(model_file_data)
-            tmp_file.flush()
-            
-            print(f"Loading model from: {model_filename}")
-            
-            # Initialize your exact trained model architecture
-            model = AAGNetSegmentor(
-                arch='AAGNetGraphEncoder',
-                num_classes=25,
-                edge_attr_dim=12,
-                node_attr_dim=10,
-                edge_attr_emb=64,
-                node_attr_emb=64,
-                edge_grid_dim=0,
-                node_grid_dim=7,
-                edge_grid_emb=0,
-                node_grid_emb=64,
-                num_layers=3,
-                delta=2,
-                mlp_ratio=2,
-                drop=0.,
-                drop_path=0.,
-                head_hidden_dim=64,
-                conv_on_edge=False
-            )
-            
-            # Load the trained weights
-            checkpoint = torch.load(tmp_file.name, map_location='cpu')
-            
-            # Handle different checkpoint formats
-            if isinstance(checkpoint, dict):
-                if 'model_state_dict' in checkpoint:
-                    model.load_state_dict(checkpoint['model_state_dict'])
-                elif 'state_dict' in checkpoint:
-                    model.load_state_dict(checkpoint['state_dict'])
-                else:
-                    model.load_state_dict(checkpoint)
+        print(f"Loading model from: {model_filename}")
+        
+        # Initialize your exact trained model architecture
+        model = AAGNetSegmentor(
+            arch='AAGNetGraphEncoder',
+            num_classes=25,
+            edge_attr_dim=12,
+            node_attr_dim=10,
+            edge_attr_emb=64,
+            node_attr_emb=64,
+            edge_grid_dim=0,
+            node_grid_dim=7,
+            edge_grid_emb=0,
+            node_grid_emb=64,
+            num_layers=3,
+            delta=2,
+            mlp_ratio=2,
+            drop=0.,
+            drop_path=0.,
+            head_hidden_dim=64,
+            conv_on_edge=False
+        )
+        
+        # Load the trained weights
+        checkpoint = torch.load(io.BytesIO(model_file_data), map_location='cpu', weights_only=True)
+        
+        # Handle different checkpoint formats
+        if isinstance(checkpoint, dict):
+            if 'model_state_dict' in checkpoint:
+                model.load_state_dict(checkpoint['model_state_dict'])
+            elif 'state_dict' in checkpoint:
+                model.load_state_dict(checkpoint['state_dict'])
             else:
                 model.load_state_dict(checkpoint)
-            
-            model.eval()
-            print("Model loaded and set to evaluation mode")
-            
-            # Clean up temporary file
-            os.unlink(tmp_file.name)
-            
+        else:
+            model.load_state_dict(checkpoint)
+        
+        model.eval()
+        print("Model loaded and set to evaluation mode")
+        
+        # Swap the Linear layers for int8 dynamically quantized ones for CPU inference
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        print("Model Linear layers quantized to int8")
+        
+        # Freeze the MLP blocks and heads into optimized TorchScript graphs; forward
+        # itself takes a duck-typed batch, so the encoder loop stays eager
+        model.mlp_layers = nn.ModuleList([
+            torch.jit.optimize_for_inference(torch.jit.script(mlp)) for mlp in model.mlp_layers
+        ])
+        for head_name in ('seg_head', 'inst_head', 'bottom_head'):
+            head = torch.jit.script(getattr(model, head_name))
+            setattr(model, head_name, torch.jit.optimize_for_inference(head))
+        print("Model MLP blocks and heads frozen with TorchScript")
+        
         return model
         
     except Exception as e:
@@ -287,6 +356,46 @@ def load_trained_model(model_files: Dict[str, bytes]) -> torch.nn.Module:
         print("Traceback:", str(e))
         raise
 
+def get_model() -> torch.nn.Module:
+    """Return the trained model, loading it once per container and again only when its checkpoint changes"""
+    global _MODEL, _MODEL_VERSION
+    
+    # Listing is cheap; use it to detect new or updated checkpoints
+    response = models_bucket.list()
+    
+    if response.data is None:
+        raise Exception("Failed to list model files")
+    
+    # load_trained_model only uses the first .pth weight file, so fetch just that one
+    checkpoint = next(
+        (file_info for file_info in response.data
+         if file_info['name'].endswith('.pth') and 'weight' in file_info['name']),
+        None
+    )
+    if checkpoint is None:
+        raise ValueError("No trained .pth model file found in storage")
+    version = (checkpoint['name'], checkpoint.get('updated_at'))
+    
+    if _MODEL is not None and version == _MODEL_VERSION:
+        print("Using cached trained model")
+        return _MODEL
+    
+    with _MODEL_LOCK:
+        # Another request may have loaded it while we waited for the lock
+        if _MODEL is not None and version == _MODEL_VERSION:
+            return _MODEL
+        
+        print("Loading trained model from storage...")
+        file_response = models_bucket.download(checkpoint['name'])
+        if not file_response.data:
+            raise Exception(f"Failed to download model file: {checkpoint['name']}")
+        print(f"Loaded model file: {checkpoint['name']}")
+        
+        # Publish the model before its version so lock-free readers never see a stale pair
+        _MODEL = load_trained_model({checkpoint['name']: file_response.data})
+        _MODEL_VERSION = version
+        return _MODEL
+
 def extract_aag_features(mesh: Dict[str, Any]) -> Dict[str, Any]:
     """Extract AAG (Attributed Adjacency Graph) features like your Python script"""
     
@@ -295,81 +404,54 @@ def extract_aag_features(mesh: Dict[str, Any]) -> Dict[str, Any]:
         node_features = mesh['face_attributes']
     else:
         # Fallback: compute basic geometric features
-        vertices = mesh['vertices']
-        faces = mesh['faces']
-        
-        features = []
-        for face in faces:
-            # Get face vertices
-            if len(face) >= 3:
-                v1, v2, v3 = vertices[face[0]], vertices[face[1]], vertices[face[2]]
-                
-                # Compute face center
-                center = (v1 + v2 + v3) / 3.0
-                
-                # Compute face normal
-                edge1 = np.array(v2) - np.array(v1)
-                edge2 = np.array(v3) - np.array(v1)
-                normal = np.cross(edge1, edge2)
-                normal = normal / (np.linalg.norm(normal) + 1e-8)
-                
-                # Compute face area
-                area = np.linalg.norm(np.cross(edge1, edge2)) / 2.0
-                
-                # Create 10D feature vector (matching your model)
-                face_attr = [
-                    area,           # area
-                    normal[0],      # normal_x
-                    normal[1],      # normal_y
-                    normal[2],      # normal_z
-                    center[0],      # center_x
-                    center[1],      # center_y
-                    center[2],      # center_z
-                    0.0,           # curvature (placeholder)
-                    0.0,           # convexity (placeholder)
-                    1.0            # planarity (placeholder)
-                ]
-                features.append(face_attr)
-        
-        node_features = np.array(features)
+        vertices = np.asarray(mesh['vertices'], dtype=np.float32)
+        faces = np.asarray(mesh['faces'])
+        
+        if faces.ndim == 2 and faces.shape[1] >= 3:
+            # Gather the first three vertices of every face in one (N, 3, 3) read
+            tri = vertices[faces[:, :3]]
+            
+            # Compute face centers
+            center = tri.mean(axis=1)
+            
+            # Compute face normals and areas from one batched cross product
+            cross = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+            cross_norm = np.sqrt(np.einsum('ij,ij->i', cross, cross))
+            normal = cross / (cross_norm[:, None] + 1e-8)
+            area = cross_norm / 2.0
+            
+            # Fill 10D feature vectors (matching your model) in one float32 buffer
+            node_features = np.empty((len(faces), 10), dtype=np.float32)
+            node_features[:, 0] = area      # area
+            node_features[:, 1:4] = normal  # normal_x, normal_y, normal_z
+            node_features[:, 4:7] = center  # center_x, center_y, center_z
+            node_features[:, 7] = 0.0       # curvature (placeholder)
+            node_features[:, 8] = 0.0       # convexity (placeholder)
+            node_features[:, 9] = 1.0       # planarity (placeholder)
+        else:
+            node_features = np.empty((0, 10), dtype=np.float32)
     
     # Get adjacency matrix
-    adjacency_matrix = mesh.get('adjacency_matrix', np.eye(len(node_features)))
+    adjacency_matrix = mesh.get('adjacency_matrix', np.eye(len(node_features), dtype=np.float32))
     
-    # Edge features (12D as per your model)
-    num_faces = len(node_features)
-    edge_features = []
-    edge_indices = []
+    # Edge features (12D as per your model) for every adjacent pair with i < j
+    edge_i, edge_j = np.nonzero(np.triu(np.asarray(adjacency_matrix), k=1) > 0)
+    face_i = node_features[edge_i]
+    face_j = node_features[edge_j]
     
-    for i in range(num_faces):
-        for j in range(i + 1, num_faces):
-            if adjacency_matrix[i, j] > 0:
-                # Compute edge features between adjacent faces
-                face_i = node_features[i]
-                face_j = node_features[j]
-                
-                # 12D edge feature vector
-                edge_feat = [
-                    abs(face_i[1] - face_j[1]),  # normal_x difference
-                    abs(face_i[2] - face_j[2]),  # normal_y difference
-                    abs(face_i[3] - face_j[3]),  # normal_z difference
-                    abs(face_i[4] - face_j[4]),  # center_x difference
-                    abs(face_i[5] - face_j[5]),  # center_y difference
-                    abs(face_i[6] - face_j[6]),  # center_z difference
-                    min(face_i[0], face_j[0]),   # min area
-                    max(face_i[0], face_j[0]),   # max area
-                    face_i[0] + face_j[0],       # area sum
-                    0.0,                         # dihedral angle (placeholder)
-                    1.0,                         # edge type (placeholder)
-                    1.0                          # edge length (placeholder)
-                ]
-                edge_features.append(edge_feat)
-                edge_indices.append([i, j])
+    edge_features = np.empty((len(edge_i), 12), dtype=np.float32)
+    edge_features[:, 0:6] = np.abs(face_i[:, 1:7] - face_j[:, 1:7])  # normal and center differences
+    edge_features[:, 6] = np.minimum(face_i[:, 0], face_j[:, 0])    # min area
+    edge_features[:, 7] = np.maximum(face_i[:, 0], face_j[:, 0])    # max area
+    edge_features[:, 8] = face_i[:, 0] + face_j[:, 0]               # area sum
+    edge_features[:, 9] = 0.0                                       # dihedral angle (placeholder)
+    edge_features[:, 10] = 1.0                                      # edge type (placeholder)
+    edge_features[:, 11] = 1.0                                      # edge length (placeholder)
     
     return {
         'node_features': node_features,
-        'edge_features': np.array(edge_features) if edge_features else np.empty((0, 12)),
-        'edge_indices': np.array(edge_indices) if edge_indices else np.empty((0, 2)),
+        'edge_features': edge_features,
+        'edge_indices': np.stack([edge_i, edge_j], axis=1),
         'adjacency_matrix': adjacency_matrix
     }
 
@@ -378,121 +460,100 @@ def run_model_inference(model: torch.nn.Module, features: np.ndarray) -> Tuple[n
     try:
         print(f"Running inference on {len(features)} geometric features...")
         
-        # Convert to tensor
-        input_tensor = torch.FloatTensor(features)
+        # Share the float32 feature buffer with torch
+        input_tensor = torch.from_numpy(np.ascontiguousarray(features, dtype=np.float32))
         
-        # Run inference with your trained model
-        with torch.no_grad():
-            # Your model returns feature logits and dimensions
+        # Your model returns feature logits and dimensions; softmax is left to
+        # interpret_predictions, which only needs the arg-max confidences
+        with torch.inference_mode():
             feature_logits, predicted_dimensions = model(input_tensor)
-            
-            # Apply softmax to get probabilities
-            probabilities = torch.softmax(feature_logits, dim=1)
-            
+        
         print("Model inference completed successfully")
-        return probabilities.numpy(), predicted_dimensions.numpy()
+        return feature_logits.numpy(), predicted_dimensions.numpy()
         
     except Exception as e:
         print(f"Error during model inference: {e}")
         print("Feature shape:", features.shape if hasattr(features, 'shape') else 'unknown')
         raise
 
-def interpret_predictions(probabilities: np.ndarray, predicted_dims: np.ndarray, features: np.ndarray, mesh: Dict[str, Any]) -> List[Dict[str, Any]]:
+def interpret_predictions(logits: np.ndarray, predicted_dims: np.ndarray, features: np.ndarray, mesh: Dict[str, Any],
+                          include_features: bool = False) -> List[Dict[str, Any]]:
     """Interpret your trained model predictions into machining features"""
     detected_features = []
     
-    # Your exact 25 feature types from the trained model
-    feat_names = [
-        'chamfer', 'through_hole', 'triangular_passage', 'rectangular_passage', '6sides_passage',
-        'triangular_through_slot', 'rectangular_through_slot', 'circular_through_slot',
-        'rectangular_through_step', '2sides_through_step', 'slanted_through_step', 'Oring', 'blind_hole',
-        'triangular_pocket', 'rectangular_pocket', '6sides_pocket', 'circular_end_pocket',
-        'rectangular_blind_slot', 'v_circular_end_blind_slot', 'h_circular_end_blind_slot',
-        'triangular_blind_step', 'circular_blind_step', 'rectangular_blind_step', 'round', 'stock'
-    ]
-    
     # Use a lower threshold since this is your trained model
     confidence_threshold = 0.6
     
     print(f"Interpreting predictions with threshold {confidence_threshold}")
     
-    for i, (prob, dims) in enumerate(zip(probabilities, predicted_dims)):
-        max_prob_idx = np.argmax(prob)
-        max_confidence = prob[max_prob_idx]
-        
-        if max_confidence > confidence_threshold:
-            # Get actual face center from mesh
-            vertices = mesh['vertices']
-            faces = mesh['faces']
-            
-            if i < len(faces):
-                face = faces[i]
-                if len(face) >= 3 and all(idx < len(vertices) for idx in face[:3]):
-                    v1, v2, v3 = vertices[face[0]], vertices[face[1]], vertices[face[2]]
-                    position = (v1 + v2 + v3) / 3.0
-                    
-                    # Use model's predicted dimensions
-                    width, height, depth = np.abs(dims)  # Ensure positive values
-                    
-                    feature_type = feat_names[max_prob_idx]
-                    
-                    feature = {
-                        'id': f'trained_model_feature_{len(detected_features)}',
-                        'type': feature_type,
-                        'confidence': float(max_confidence),
-                        'position': position.tolist(),
-                        'dimensions': {
-                            'diameter': float(width) if feature_type == 'hole' else None,
-                            'width': float(width),
-                            'height': float(height),
-                            'depth': float(depth)
-                        },
-                        'normal': mesh['normals'][i].tolist() if i < len(mesh['normals']) else [0, 0, 1],
-                        'machining_params': generate_machining_params(feature_type, float(width)),
-                        'model_prediction': True,  # Mark as actual model prediction
-                        'geometric_features': features[i].tolist()  # Include input features for validation
-                    }
-                    
-                    detected_features.append(feature)
-                    print(f"Detected {feature_type} with confidence {max_confidence:.3f}")
+    # Threshold all faces at once so only detected faces reach the Python loop
+    max_prob_idx = np.argmax(logits, axis=1)
+    max_logits = logits[np.arange(len(logits)), max_prob_idx]
+    
+    # Softmax probability of the arg-max class only, without normalizing every row
+    max_confidence = 1.0 / np.exp(logits - max_logits[:, None]).sum(axis=1)
+    detected = np.where(max_confidence > confidence_threshold)[0]
+    
+    # Keep only faces that exist in the mesh and reference valid vertices
+    vertices = np.asarray(mesh['vertices'])
+    faces = np.asarray(mesh['faces'])
+    normals = mesh.get('normals', [])
+    if faces.ndim != 2 or faces.shape[1] < 3:
+        detected = detected[:0]
+    detected = detected[detected < len(faces)]
+    detected = detected[(faces[detected, :3] < len(vertices)).all(axis=1)]
+    
+    # Get actual face centers from mesh for the detected faces
+    positions = vertices[faces[detected, :3]].mean(axis=1)
+    
+    # Use model's predicted dimensions, made positive in one pass
+    dimensions = np.abs(predicted_dims[detected])
+    
+    # Tool diameters for all detections at once, scaled per detected class
+    detected_classes = max_prob_idx[detected]
+    tool_diameters = dimensions[:, 0] * CLASS_DIAMETER_RATIOS[detected_classes]
+    
+    # Convert the detected rows to Python values in bulk rather than per feature
+    confidences = max_confidence[detected].tolist()
+    position_lists = positions.tolist()
+    dimension_lists = dimensions.tolist()
+    tool_diameter_list = tool_diameters.tolist()
+    
+    for k, (i, class_idx) in enumerate(zip(detected.tolist(), detected_classes.tolist())):
+        feature_type = FEAT_NAMES[class_idx]
+        tool_type, _, fixed_params = CLASS_MACHINING_PARAMS[class_idx]
+        width, height, depth = dimension_lists[k]
+        
+        feature = {
+            'id': f'trained_model_feature_{len(detected_features)}',
+            'type': feature_type,
+            'confidence': confidences[k],
+            'position': position_lists[k],
+            'dimensions': {
+                'diameter': width if feature_type == 'hole' else None,
+                'width': width,
+                'height': height,
+                'depth': depth
+            },
+            'normal': normals[i].tolist() if i < len(normals) else [0, 0, 1],
+            'machining_params': {'tool_type': tool_type, 'tool_diameter': tool_diameter_list[k], **fixed_params},
+            'model_prediction': True  # Mark as actual model prediction
+        }
+        if include_features:
+            feature['geometric_features'] = features[i].tolist()  # Input features for validation
+        
+        detected_features.append(feature)
+        print(f"Detected {feature_type} with confidence {confidences[k]:.3f}")
     
     print(f"Total features detected by trained model: {len(detected_features)}")
     return detected_features
 
 def generate_machining_params(feature_type: str, dimension: float) -> Dict[str, Any]:
     """Generate machining parameters for detected features"""
-    if feature_type == 'hole':
-        return {
-            'tool_type': 'drill',
-            'tool_diameter': dimension * 0.9,
-            'speed': 1200,
-            'feed_rate': 0.1,
-            'plunge_rate': 0.05
-        }
-    elif feature_type == 'pocket':
-        return {
-            'tool_type': 'end_mill',
-            'tool_diameter': dimension * 0.3,
-            'speed': 800,
-            'feed_rate': 0.2,
-            'step_over': 0.6,
-            'step_down': 0.5
-        }
-    elif feature_type == 'slot':
-        return {
-            'tool_type': 'end_mill',
-            'tool_diameter': dimension * 0.8,
-            'speed': 1000,
-            'feed_rate': 0.15,
-            'step_down': 0.3
-        }
-    else:
-        return {
-            'tool_type': 'end_mill',
-            'tool_diameter': dimension * 0.5,
-            'speed': 1000,
-            'feed_rate': 0.1
-        }
+    tool_type, diameter_ratio, fixed_params = MACHINING_PARAMS.get(feature_type, DEFAULT_MACHINING_PARAMS)
+    params = {'tool_type': tool_type, 'tool_diameter': dimension * diameter_ratio}
+    params.update(fixed_params)
+    return params
 
 def handler(request):
     """Main handler function for the Edge Function"""
@@ -505,88 +566,78 @@ def handler(request):
         
         print(f"🔥 PYTHON EDGE FUNCTION CALLED! Processing: {file_name}")
         print(f"🔥 Analysis params: {analysis_params}")
-        print(f"🔥 About to load YOUR TRAINED MODEL from storage...")
-        
-        # Load model files from storage
-        print("Loading trained model from storage...")
-        response = supabase.storage.from_('models').list()
-        
-        if response.data is None:
-            raise Exception("Failed to list model files")
-        
-        model_files = {}
-        for file_info in response.data:
-            file_response = supabase.storage.from_('models').download(file_info['name'])
-            if file_response.data:
-                model_files[file_info['name']] = file_response.data
-                print(f"Loaded model file: {file_info['name']}")
         
-        # Load the trained model
-        model = load_trained_model(model_files)
-        print("Model loaded successfully")
+        # Reject empty or oversized payloads before any parsing or model work
+        if not step_data:
+            raise InvalidRequestError("No STEP data provided")
+        if not isinstance(step_data, str):
+            raise InvalidRequestError("STEP data must be a base64 string")
+        if len(step_data) * 3 // 4 > MAX_STEP_BYTES:
+            raise InvalidRequestError(f"STEP data exceeds the {MAX_STEP_BYTES // (1024 * 1024)} MB limit")
         
         # Parse STEP data and extract AAG features
         mesh = parse_step_to_mesh(step_data)
         print(f"Parsed mesh with {mesh['num_faces']} faces")
         
+        if mesh['num_faces'] == 0:
+            raise InvalidRequestError("STEP data contains no faces")
+        
         # Extract AAG features like your Python script
         aag_features = extract_aag_features(mesh)
         print(f"Extracted AAG with {len(aag_features['node_features'])} nodes and {len(aag_features['edge_features'])} edges")
         
+        # Load the trained model (cached across warm invocations) only for valid input
+        print(f"🔥 About to load YOUR TRAINED MODEL from storage...")
+        model = get_model()
+        print("Model loaded successfully")
+        
         # Create a mock graph batch for the model (simplified for now)
         class MockBatch:
             def __init__(self, node_features):
-                self.x = torch.FloatTensor(node_features)
+                # Node features are already float32; share their memory with torch
+                self.x = torch.from_numpy(np.ascontiguousarray(node_features, dtype=np.float32))
         
         mock_batch = MockBatch(aag_features['node_features'])
         
         # Run model inference with your trained AAGNet model
-        with torch.no_grad():
+        with torch.inference_mode():
             seg_out, inst_out, bottom_out = model(mock_batch)
             face_logits = seg_out.cpu().numpy()
             inst_matrix = inst_out[0].sigmoid()
-            adj = (inst_matrix > 0.5).cpu().numpy().astype('int32')
+            adj = (inst_matrix > 0.5).cpu().numpy()
             bottom_logits = (bottom_out.sigmoid() > 0.5).cpu().numpy()
         
         print("Model inference completed")
         
         # Feature clustering like your Python script
-        proposals = set()
-        used_flags = np.zeros(adj.shape[0], dtype=np.bool8)
-        eps = 1e-6
+        proposals = []
+        used_flags = np.zeros(adj.shape[0], dtype=bool)
+        
+        # Each unused face with any links claims all of its still-unused linked
+        # faces; only the walk over rows stays in Python
+        has_links = adj.any(axis=1)
         
         for row_idx, row in enumerate(adj):
-            if used_flags[row_idx] or np.sum(row) <= eps:
+            if used_flags[row_idx] or not has_links[row_idx]:
                 continue
-            proposal = set()
-            for col_idx, item in enumerate(row):
-                if not used_flags[col_idx] and item:
-                    proposal.add(col_idx)
-                    used_flags[col_idx] = True
-            if proposal:
-                proposals.add(frozenset(proposal))
+            proposal = np.flatnonzero(row & ~used_flags)
+            used_flags[proposal] = True
+            if proposal.size:
+                proposals.append(proposal)
         
         # Create feature instances from proposals
         detected_features = []
-        feat_names = [
-            'chamfer', 'through_hole', 'triangular_passage', 'rectangular_passage', '6sides_passage',
-            'triangular_through_slot', 'rectangular_through_slot', 'circular_through_slot',
-            'rectangular_through_step', '2sides_through_step', 'slanted_through_step', 'Oring', 'blind_hole',
-            'triangular_pocket', 'rectangular_pocket', '6sides_pocket', 'circular_end_pocket',
-            'rectangular_blind_slot', 'v_circular_end_blind_slot', 'h_circular_end_blind_slot',
-            'triangular_blind_step', 'circular_blind_step', 'rectangular_blind_step', 'round', 'stock'
-        ]
         
         for instance in proposals:
-            instance_list = list(instance)
-            sum_inst_logit = sum(face_logits[face] for face in instance_list)
+            instance_list = instance.tolist()
+            sum_inst_logit = face_logits[instance].sum(axis=0)
             inst_logit = np.argmax(sum_inst_logit)
             
-            if inst_logit == 24:  # skip stock
+            if inst_logit == STOCK_CLASS:
                 continue
                 
-            inst_name = feat_names[inst_logit]
-            bottoms = [f for f in instance_list if bottom_logits[f]]
+            inst_name = FEAT_NAMES[inst_logit]
+            bottoms = instance[bottom_logits[instance]].tolist()
             confidence = float(np.max(sum_inst_logit) / len(instance_list))
             
             # Get feature position from first face
@@ -596,9 +647,7 @@ def handler(request):
                     face = mesh['faces'][face_idx]
                     if len(face) >= 3:
                         v1, v2, v3 = mesh['vertices'][face[0]], mesh['vertices'][face[1]], mesh['vertices'][face[2]]
-                        position = [(v1[0] + v2[0] + v3[0]) / 3.0, 
-                                   (v1[1] + v2[1] + v3[1]) / 3.0, 
-                                   (v1[2] + v2[2] + v3[2]) / 3.0]
+                        position = ((v1 + v2 + v3) / 3.0).tolist()
                         
                         # Mock dimensions (replace with actual computation)
                         width = np.random.uniform(5, 20)
@@ -629,7 +678,7 @@ def handler(request):
         
         # Return results
         result = {
-            'analysis_id': f'python_aagnet_{int(np.random.random() * 1000000)}',
+            'analysis_id': f'python_aagnet_{secrets.token_hex(8)}',
             'status': 'completed',
             'features': detected_features,
             'metadata': {
@@ -656,6 +705,20 @@ def handler(request):
             'body': json.dumps(result)
         }
         
+    except InvalidRequestError as e:
+        print(f"Rejected Python AAGNet request: {e}")
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Headers': 'authorization, x-client-info, apikey, content-type',
+            },
+            'body': json.dumps({
+                'error': str(e),
+                'status': 'error'
+            })
+        }
     except Exception as e:
         print(f"Error in Python AAGNet inference: {e}")
         return {